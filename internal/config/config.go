@@ -50,6 +50,10 @@ type SemanticConfig struct {
 	TimeoutMs     int
 	Model         string
 	TagsThreshold int
+	Backend       string
+	FP16          bool
+	Debug         bool
+	MaxSeqLength  int
 	Python        PythonConfig
 }
 
@@ -111,6 +115,10 @@ func Load() (*Config, error) {
 			TimeoutMs:     getEnvInt("SEMANTIC_TIMEOUT_MS", 10000),
 			Model:         getEnv("SEMANTIC_MODEL_NAME", "all-MiniLM-L6-v2"),
 			TagsThreshold: getEnvInt("SEMANTIC_TAGS_THRESHOLD", 15),
+			Backend:       getEnv("SEMANTIC_BACKEND", "torch"),
+			FP16:          getEnvBool("SEMANTIC_FP16", false),
+			Debug:         getEnvBool("SEMANTIC_DEBUG", false),
+			MaxSeqLength:  getEnvInt("SEMANTIC_MAX_SEQ_LENGTH", 128),
 			Python: PythonConfig{
 				ConfigDir: getEnv("SEMANTIC_PYTHON_CONFIG_DIR", defaultPythonDir),
 			},
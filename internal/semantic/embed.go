@@ -10,4 +10,6 @@ var embeddedRequirements string
 
 const defaultRequirements = `sentence-transformers>=2.2.2
 torch>=2.0.0
-numpy>=1.21.0`
+numpy>=1.21.0
+orjson>=3.9.0
+simsimd>=6.0.0`
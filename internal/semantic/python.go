@@ -2,18 +2,34 @@ package semantic
 
 import (
 	"bufio"
+	"bytes"
+	"encoding/binary"
 	"encoding/json"
 	"fmt"
 	"io"
 	"os"
 	"os/exec"
 	"path/filepath"
+	"strings"
 	"sync"
+	"time"
 
 	"github.com/wgomg/itzamna/internal/config"
 	"github.com/wgomg/itzamna/internal/utils"
 )
 
+const (
+	shutdownTimeout = 5 * time.Second
+	// The first start may download the model, so READY can take a while
+	startupTimeout = 10 * time.Minute
+	// Most queued tasks written to the script before reading their responses;
+	// also sent as the script's max_batch_size
+	maxPipelinedTasks = 32
+	// Far above any real request or response; a larger length means the
+	// stream is out of sync
+	maxFrameSize = 64 << 20
+)
+
 type Task struct {
 	RequestID string
 	Text      string
@@ -34,7 +50,7 @@ type PythonMatcher struct {
 	process   *exec.Cmd
 	stdin     io.WriteCloser
 	stdout    io.ReadCloser
-	scanner   *bufio.Scanner
+	reader    *bufio.Reader
 	mu        sync.Mutex
 	taskQueue chan Task
 	closed    bool
@@ -42,7 +58,7 @@ type PythonMatcher struct {
 
 type PythonRequest struct {
 	Text    string   `json:"text"`
-	NewTags []string `json:"new_tags"`
+	NewTags []string `json:"new_tags,omitempty"`
 }
 
 type PythonResponse struct {
@@ -133,54 +149,59 @@ func (p *PythonMatcher) startProcess() error {
 		return fmt.Errorf("start process: %w", err)
 	}
 
+	// Closing the pipes alone would leave a half-started script running
+	abort := func(err error) error {
+		stdin.Close()
+		stdout.Close()
+		cmd.Process.Kill()
+		cmd.Wait()
+		return err
+	}
+
 	config := map[string]interface{}{
 		"model_name":           p.cfg.Model,
 		"top_n":                p.cfg.TopN,
 		"min_similarity":       p.cfg.MinSimilarity,
 		"normalize_embeddings": true,
+		"cache_dir":            filepath.Join(p.cfg.Python.ConfigDir, "cache"),
+		"backend":              p.cfg.Backend,
+		"fp16":                 p.cfg.FP16,
+		"debug":                p.cfg.Debug,
+		"max_seq_length":       p.cfg.MaxSeqLength,
+		"max_batch_size":       maxPipelinedTasks,
 	}
 
 	configJSON, err := json.Marshal(config)
 	if err != nil {
-		stdin.Close()
-		stdout.Close()
-		return fmt.Errorf("marshal config: %w", err)
+		return abort(fmt.Errorf("marshal config: %w", err))
 	}
 
-	configJSON = append(configJSON, '\n')
-	if _, err := stdin.Write(configJSON); err != nil {
-		stdin.Close()
-		stdout.Close()
-		return fmt.Errorf("send config: %w", err)
+	if err := writeFrame(stdin, configJSON); err != nil {
+		return abort(fmt.Errorf("send config: %w", err))
 	}
 
-	scanner := bufio.NewScanner(stdout)
-	if !scanner.Scan() {
-		stdin.Close()
-		stdout.Close()
-		return fmt.Errorf("failed to read READY message")
+	reader := bufio.NewReader(stdout)
+	readyJSON, err := readReady(reader, startupTimeout)
+	if err != nil {
+		return abort(fmt.Errorf("failed to read READY message: %w", err))
 	}
 
 	var readyMsg struct {
 		Status       string `json:"status"`
 		EmbeddingDim int    `json:"embedding_dim"`
 	}
-	if err := json.Unmarshal([]byte(scanner.Text()), &readyMsg); err != nil {
-		stdin.Close()
-		stdout.Close()
-		return fmt.Errorf("failed to parse ready message: %w", err)
+	if err := json.Unmarshal(readyJSON, &readyMsg); err != nil {
+		return abort(fmt.Errorf("failed to parse ready message: %w", err))
 	}
 
 	if readyMsg.Status != "ready" {
-		stdin.Close()
-		stdout.Close()
-		return fmt.Errorf("unexpected startup status: %s", readyMsg.Status)
+		return abort(fmt.Errorf("unexpected startup status: %s", readyMsg.Status))
 	}
 
 	p.process = cmd
 	p.stdin = stdin
 	p.stdout = stdout
-	p.scanner = scanner
+	p.reader = reader
 
 	p.logger.Info(nil, "Python matcher ready (embedding_dim=%d)", readyMsg.EmbeddingDim)
 
@@ -189,64 +210,191 @@ func (p *PythonMatcher) startProcess() error {
 
 func (p *PythonMatcher) handleRequests() {
 	for task := range p.taskQueue {
-		p.processTask(task)
+		tasks := []Task{task}
+		for len(tasks) < maxPipelinedTasks && len(p.taskQueue) > 0 {
+			tasks = append(tasks, <-p.taskQueue)
+		}
+		p.processTasks(tasks)
 	}
 }
 
-func (p *PythonMatcher) processTask(task Task) {
+// processTasks writes the frames of all tasks before reading any response, so
+// the script finds them pending and embeds them as one batch. Responses come
+// back in request order.
+func (p *PythonMatcher) processTasks(tasks []Task) {
 	if p.closed {
-		task.Result <- TaskResult{Err: fmt.Errorf("python matcher closed")}
+		for _, task := range tasks {
+			task.Result <- TaskResult{Err: fmt.Errorf("python matcher closed")}
+		}
+		return
 	}
 
-	req := PythonRequest{
-		Text:    task.Text,
-		NewTags: task.NewTags,
+	sent := make([]Task, 0, len(tasks))
+	frames := make([][]byte, 0, len(tasks))
+	for _, task := range tasks {
+		reqJSON, err := encodeRequest(task.Text, task.NewTags)
+		if err != nil {
+			task.Result <- TaskResult{Err: fmt.Errorf("marshal request: %w", err)}
+			continue
+		}
+		sent = append(sent, task)
+		frames = append(frames, reqJSON)
+	}
+
+	// Write concurrently with reading: the script may answer the first frames
+	// before it has read the last, and neither side must block on a full pipe
+	writeErr := make(chan error, 1)
+	go func() {
+		for _, frame := range frames {
+			if err := writeFrame(p.stdin, frame); err != nil {
+				writeErr <- err
+				return
+			}
+		}
+		writeErr <- nil
+	}()
+
+	for i, task := range sent {
+		respJSON, err := readFrame(p.reader)
+		if err != nil {
+			if err == io.EOF {
+				err = fmt.Errorf("stdout closed")
+			} else {
+				err = fmt.Errorf("read stdout: %w", err)
+			}
+			select {
+			case werr := <-writeErr:
+				if werr != nil {
+					err = fmt.Errorf("write request: %w", werr)
+				}
+			default:
+			}
+
+			// The stream is broken, so no later response will arrive either
+			for _, pending := range sent[i:] {
+				pending.Result <- TaskResult{Err: err}
+			}
+			return
+		}
+
+		task.Result <- p.parseResponse(task, respJSON)
 	}
+}
 
-	if req.NewTags == nil {
-		req.NewTags = []string{}
+func (p *PythonMatcher) parseResponse(task Task, respJSON []byte) TaskResult {
+	var resp PythonResponse
+	if err := json.Unmarshal(respJSON, &resp); err != nil {
+		return TaskResult{Err: fmt.Errorf("parse response: %w", err)}
+	}
+	if resp.Error != nil && *resp.Error != "" {
+		return TaskResult{Err: fmt.Errorf("python error: %s", *resp.Error)}
+	}
+
+	p.logger.Info(
+		&task.RequestID,
+		"Semantic matcher stats: process_ms=%d, total_tags=%d, tags_above_threshold=%d",
+		resp.DebugInfo.ProcessingTimeMS,
+		resp.DebugInfo.TotalTagsConsidered,
+		resp.DebugInfo.TagsAboveThreshold,
+	)
+	return TaskResult{Tags: resp.SuggestedTags}
+}
+
+// encodeRequest builds a request frame payload: the JSON request, followed by a
+// NUL byte and the tags blob. Tags that cannot go in a blob are sent as new_tags.
+func encodeRequest(text string, tags []string) ([]byte, error) {
+	req := PythonRequest{Text: text}
+	blob, ok := encodeTagsBlob(tags)
+	if !ok {
+		req.NewTags = tags
 	}
 
 	reqJSON, err := json.Marshal(req)
 	if err != nil {
-		task.Result <- TaskResult{Err: fmt.Errorf("marshal request: %w", err)}
-		return
+		return nil, err
 	}
 
-	reqJSON = append(reqJSON, '\n')
-	if _, err := p.stdin.Write(reqJSON); err != nil {
-		task.Result <- TaskResult{Err: fmt.Errorf("write request: %w", err)}
-		return
+	if len(blob) > 0 {
+		reqJSON = append(append(reqJSON, 0), blob...)
 	}
+	return reqJSON, nil
+}
 
-	if p.scanner.Scan() {
-		var resp PythonResponse
-		if err := json.Unmarshal([]byte(p.scanner.Text()), &resp); err != nil {
-			task.Result <- TaskResult{Err: fmt.Errorf("parse response: %w", err)}
-			return
+// encodeTagsBlob joins tags with NUL bytes so the script can split them in one
+// pass. It reports false when a tag itself contains a NUL byte.
+func encodeTagsBlob(tags []string) ([]byte, bool) {
+	size := 0
+	for _, tag := range tags {
+		if strings.IndexByte(tag, 0) >= 0 {
+			return nil, false
 		}
-		if resp.Error != nil && *resp.Error != "" {
-			task.Result <- TaskResult{Err: fmt.Errorf("python error: %s", *resp.Error)}
-			return
+		size += len(tag) + 1
+	}
+
+	blob := make([]byte, 0, size)
+	for i, tag := range tags {
+		if i > 0 {
+			blob = append(blob, 0)
 		}
+		blob = append(blob, tag...)
+	}
 
-		p.logger.Info(
-			&task.RequestID,
-			"Semantic matcher stats: process_ms=%d, total_tags=%d, tags_above_threshold=%d",
-			resp.DebugInfo.ProcessingTimeMS,
-			resp.DebugInfo.TotalTagsConsidered,
-			resp.DebugInfo.TagsAboveThreshold,
-		)
-		task.Result <- TaskResult{Tags: resp.SuggestedTags}
-		return
+	return blob, true
+}
+
+// writeFrame sends one message as a 4-byte little-endian length followed by the payload.
+func writeFrame(w io.Writer, payload []byte) error {
+	frame := make([]byte, 4+len(payload))
+	binary.LittleEndian.PutUint32(frame, uint32(len(payload)))
+	copy(frame[4:], payload)
+
+	_, err := w.Write(frame)
+	return err
+}
+
+// readFrame reads one length-prefixed message written by the Python script.
+func readFrame(r *bufio.Reader) ([]byte, error) {
+	var header [4]byte
+	if _, err := io.ReadFull(r, header[:]); err != nil {
+		return nil, err
 	}
 
-	if err := p.scanner.Err(); err != nil {
-		task.Result <- TaskResult{Err: fmt.Errorf("read stdout: %w", err)}
-		return
+	size := binary.LittleEndian.Uint32(header[:])
+	if size > maxFrameSize {
+		return nil, fmt.Errorf("frame of %d bytes exceeds limit of %d", size, maxFrameSize)
+	}
+
+	payload := make([]byte, size)
+	if _, err := io.ReadFull(r, payload); err != nil {
+		if err == io.EOF {
+			err = io.ErrUnexpectedEOF
+		}
+		return nil, err
 	}
 
-	task.Result <- TaskResult{Err: fmt.Errorf("stdout closed")}
+	return payload, nil
+}
+
+// readReady reads the READY frame, giving up after timeout so a script that
+// never answers cannot hang startup.
+func readReady(r *bufio.Reader, timeout time.Duration) ([]byte, error) {
+	type result struct {
+		payload []byte
+		err     error
+	}
+
+	done := make(chan result, 1)
+	go func() {
+		payload, err := readFrame(r)
+		done <- result{payload, err}
+	}()
+
+	select {
+	case res := <-done:
+		return res.payload, res.err
+	case <-time.After(timeout):
+		return nil, fmt.Errorf("no response within %s", timeout)
+	}
 }
 
 func (p *PythonMatcher) Close() {
@@ -260,7 +408,16 @@ func (p *PythonMatcher) Close() {
 		p.stdin.Close()
 	}
 	if p.process != nil {
-		p.process.Process.Kill()
+		// EOF on stdin lets the script flush its embedding cache to disk
+		done := make(chan error, 1)
+		go func() { done <- p.process.Wait() }()
+
+		select {
+		case <-done:
+		case <-time.After(shutdownTimeout):
+			p.process.Process.Kill()
+			<-done
+		}
 	}
 	if p.stdout != nil {
 		p.stdout.Close()
@@ -329,6 +486,11 @@ func (p *PythonMatcher) installRequirements() error {
 		"sentence-transformers>=2.2.2",
 		"torch>=2.0.0",
 		"numpy>=1.21.0",
+		"orjson>=3.9.0",
+		"simsimd>=6.0.0",
+	}
+	if p.cfg.Backend == "onnx" {
+		requirements = append(requirements, "sentence-transformers[onnx]>=3.2.0")
 	}
 
 	for _, req := range requirements {
@@ -351,31 +513,51 @@ func (p *PythonMatcher) extractScriptIfNeeded() error {
 		return fmt.Errorf("failed to create python directory: %w", err)
 	}
 
-	if _, err := os.Stat(p.script); err == nil {
-		p.logger.Debug(nil, "Python script already exists at %s", p.script)
-		return nil
-	}
-
-	p.logger.Info(nil, "Extracting embedded Python script to %s", p.script)
-
-	if err := os.WriteFile(p.script, []byte(embeddedPythonScript), 0755); err != nil {
-		return fmt.Errorf("failed to write python script: %w", err)
-	}
-
 	requirementsPath := filepath.Join(pythonDir, "requirements.txt")
 	requirementsContent := embeddedRequirements
 	if requirementsContent == "" {
 		requirementsContent = defaultRequirements
 	}
 
-	if err := os.WriteFile(requirementsPath, []byte(requirementsContent), 0644); err != nil {
+	// Rewrite on any difference so an upgrade never runs an older script
+	// against a newer protocol
+	scriptWritten, err := writeFileIfChanged(p.script, []byte(embeddedPythonScript), 0755)
+	if err != nil {
+		return fmt.Errorf("failed to write python script: %w", err)
+	}
+
+	requirementsWritten, err := writeFileIfChanged(
+		requirementsPath,
+		[]byte(requirementsContent),
+		0644,
+	)
+	if err != nil {
 		return fmt.Errorf("failed to write requirements file: %w", err)
 	}
 
+	if !scriptWritten && !requirementsWritten {
+		p.logger.Debug(nil, "Python script at %s is up to date", p.script)
+		return nil
+	}
+
 	p.logger.Info(nil, "Python script extracted successfully")
 	return nil
 }
 
+// writeFileIfChanged writes data to path unless the file already holds exactly
+// that content. It reports whether the file was written.
+func writeFileIfChanged(path string, data []byte, perm os.FileMode) (bool, error) {
+	current, err := os.ReadFile(path)
+	if err == nil && bytes.Equal(current, data) {
+		return false, nil
+	}
+
+	if err := os.WriteFile(path, data, perm); err != nil {
+		return false, err
+	}
+	return true, nil
+}
+
 func (p *PythonMatcher) HealthCheck() error {
 	testTags := []string{"test", "document", "invoice"}
 
@@ -0,0 +1,110 @@
+package semantic
+
+import (
+	"bufio"
+	"bytes"
+	"encoding/binary"
+	"encoding/json"
+	"errors"
+	"io"
+	"testing"
+	"time"
+)
+
+func TestFrameRoundTrip(t *testing.T) {
+	var buf bytes.Buffer
+	payloads := [][]byte{[]byte(`{"text":"invoice"}`), {}, []byte("a\x00b\x00c")}
+
+	for _, payload := range payloads {
+		if err := writeFrame(&buf, payload); err != nil {
+			t.Fatalf("writeFrame: %v", err)
+		}
+	}
+
+	r := bufio.NewReader(&buf)
+	for _, want := range payloads {
+		got, err := readFrame(r)
+		if err != nil {
+			t.Fatalf("readFrame: %v", err)
+		}
+		if !bytes.Equal(got, want) {
+			t.Fatalf("readFrame = %q, want %q", got, want)
+		}
+	}
+
+	if _, err := readFrame(r); err != io.EOF {
+		t.Fatalf("readFrame at end = %v, want io.EOF", err)
+	}
+}
+
+func TestReadFrameTruncatedHeader(t *testing.T) {
+	r := bufio.NewReader(bytes.NewReader([]byte{5, 0}))
+
+	if _, err := readFrame(r); !errors.Is(err, io.ErrUnexpectedEOF) {
+		t.Fatalf("readFrame = %v, want io.ErrUnexpectedEOF", err)
+	}
+}
+
+func TestReadFrameTruncatedPayload(t *testing.T) {
+	var buf bytes.Buffer
+	if err := writeFrame(&buf, []byte("hello")); err != nil {
+		t.Fatalf("writeFrame: %v", err)
+	}
+	r := bufio.NewReader(bytes.NewReader(buf.Bytes()[:buf.Len()-2]))
+
+	if _, err := readFrame(r); !errors.Is(err, io.ErrUnexpectedEOF) {
+		t.Fatalf("readFrame = %v, want io.ErrUnexpectedEOF", err)
+	}
+}
+
+func TestReadFrameTooLarge(t *testing.T) {
+	var header [4]byte
+	binary.LittleEndian.PutUint32(header[:], maxFrameSize+1)
+	r := bufio.NewReader(bytes.NewReader(header[:]))
+
+	if _, err := readFrame(r); err == nil {
+		t.Fatal("readFrame accepted a frame above maxFrameSize")
+	}
+}
+
+func TestEncodeRequestTagsBlob(t *testing.T) {
+	payload, err := encodeRequest("doc", []string{"invoice", "receipt", "tax"})
+	if err != nil {
+		t.Fatalf("encodeRequest: %v", err)
+	}
+
+	want := `{"text":"doc"}` + "\x00invoice\x00receipt\x00tax"
+	if string(payload) != want {
+		t.Fatalf("encodeRequest = %q, want %q", payload, want)
+	}
+}
+
+func TestEncodeRequestNULTagFallsBackToNewTags(t *testing.T) {
+	tags := []string{"invoice", "bad\x00tag"}
+
+	payload, err := encodeRequest("doc", tags)
+	if err != nil {
+		t.Fatalf("encodeRequest: %v", err)
+	}
+	// A raw NUL would be taken as the start of a tags blob
+	if bytes.IndexByte(payload, 0) >= 0 {
+		t.Fatalf("payload contains a raw NUL: %q", payload)
+	}
+
+	var req PythonRequest
+	if err := json.Unmarshal(payload, &req); err != nil {
+		t.Fatalf("unmarshal request: %v", err)
+	}
+	if len(req.NewTags) != len(tags) || req.NewTags[0] != tags[0] || req.NewTags[1] != tags[1] {
+		t.Fatalf("new_tags = %q, want %q", req.NewTags, tags)
+	}
+}
+
+func TestReadReadyTimeout(t *testing.T) {
+	pr, pw := io.Pipe()
+	defer pw.Close()
+
+	if _, err := readReady(bufio.NewReader(pr), 10*time.Millisecond); err == nil {
+		t.Fatal("readReady returned without a READY frame")
+	}
+}
@@ -6,19 +6,32 @@ Python script that provides semantic tag matching functionality to Go service
 via stdin/stdout JSON communication. Uses sentence-transformers with
 all-MiniLM-L6-v2 model.
 
-Communication: JSON over stdin/stdout, one object per line
+Communication: JSON over stdin/stdout, each message prefixed with its
+length as a 4-byte little-endian integer
 """
 
+import hashlib
 import json
+import os
+import re
+import select
 import sys
 import time
 import traceback
+from collections import OrderedDict
 
 import numpy as np
+import orjson
 
 try:
+    import torch
     from sentence_transformers import SentenceTransformer
 
+    try:
+        from sentence_transformers.sentence_transformer import modules as st_modules
+    except ImportError:  # sentence-transformers < 6
+        from sentence_transformers import models as st_modules
+
     HAS_DEPENDENCIES = True
 except ImportError:
     HAS_DEPENDENCIES = False
@@ -28,32 +41,513 @@ except ImportError:
     )
     sys.exit(1)
 
+try:
+    import simsimd
+
+    HAS_SIMSIMD = True
+except ImportError:
+    HAS_SIMSIMD = False
+
+I8_SCALE = 127
+INITIAL_CAPACITY = 1024
+READ_CHUNK_SIZE = 1 << 16
+FRAME_HEADER_SIZE = 4
+
+
+def compute_scores(tag_matrix, doc_embedding, out):
+    """Write the inner product of every tag embedding row with the document into out."""
+    doc_embedding = np.ascontiguousarray(doc_embedding, dtype=tag_matrix.dtype)
+    if HAS_SIMSIMD:
+        simsimd.cdist(
+            tag_matrix,
+            doc_embedding.reshape(1, -1),
+            metric="dot",
+            out=out.reshape(-1, 1),
+        )
+    else:
+        np.matmul(tag_matrix, doc_embedding, out=out)
+
+    return out
+
+
+def quantize_i8(embeddings):
+    """Map L2-normalized embeddings onto int8, scaled by I8_SCALE."""
+    return np.clip(np.rint(embeddings * I8_SCALE), -I8_SCALE, I8_SCALE).astype(np.int8)
+
+
+def select_top(scores, candidates, top_n):
+    """Indices of the top_n highest scoring candidates, best first."""
+    k = min(top_n, candidates.size)
+    if k <= 0:
+        return candidates[:0]
+
+    if k < candidates.size:
+        candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
 
 class EmbeddingCache:
-    def __init__(self, model, cfg):
+    def __init__(self, model, cfg, embedding_dim):
         self.model = model
-        self.cache = {}
         self.cfg = cfg
+        # int8 scoring only pays off through SimSIMD's integer kernels and is only
+        # meaningful for unit-length vectors, so keep f32 everywhere else
+        self.quantize = (
+            HAS_SIMSIMD
+            and cfg.get("normalize_embeddings", True)
+            and cfg.get("quantize_embeddings", True)
+        )
+        self.dtype = np.int8 if self.quantize else np.float32
+
+        # One row per tag, so scoring is a single pass over matrix[:len(tags)]
+        self.matrix = np.empty((INITIAL_CAPACITY, embedding_dim), dtype=self.dtype)
+        self.tags = []
+        self.tag_to_idx = {}
+        self.tag_to_idx_bytes = {}
+        self.scores = np.empty(INITIAL_CAPACITY, dtype=np.float32)
+
+        # Rows saved by a previous run; only reused for tags the Go service sends
+        # again, so tags deleted in Paperless are never scored and drop out on save
+        self.stored_matrix = None
+        self.stored_idx = {}
+
+        self.dirty = False
+        self.save_interval = cfg.get("cache_save_interval", 20)
+        self._requests_since_save = self.save_interval
+        self.path = None
+        cache_dir = cfg.get("cache_dir")
+        if cache_dir:
+            model_name = cfg.get("model_name", "all-MiniLM-L6-v2")
+            self.path = os.path.join(cache_dir, safe_filename(model_name))
+            self.load()
+
+    def __len__(self):
+        return len(self.tags)
 
     def get_embeddings(self, new_tags):
         """Get embeddings for tags, computes missing ones."""
-        if len(new_tags) > 0:
+        # Numbers are taken as their text; lists, dicts, booleans and nulls are
+        # malformed and dropped rather than stringified into bogus tags
+        tags = (
+            t if isinstance(t, str) else str(t)
+            for t in new_tags
+            if isinstance(t, (str, int, float)) and not isinstance(t, bool)
+        )
+        missing = [t for t in dict.fromkeys(tags) if t not in self.tag_to_idx]
+
+        reused = [t for t in missing if t in self.stored_idx]
+        if reused:
+            rows = self.stored_matrix[[self.stored_idx[t] for t in reused]]
+            self._append(reused, rows)
+            missing = [t for t in missing if t not in self.stored_idx]
+
+        if missing:
+            # encode() already length-sorts its input before batching, so the
+            # batch size is the only padding knob left to tune
             new_embeddings = self.model.encode(
-                new_tags, normalize_embeddings=self.cfg.get("normalize_embeddings", True)
+                missing,
+                batch_size=self.cfg.get("encode_batch_size", 64),
+                normalize_embeddings=self.cfg.get("normalize_embeddings", True),
+                convert_to_numpy=True,
+                show_progress_bar=False,
             )
+            # fp16 models return float16; pin to float32 so scoring never mixes dtypes
+            new_embeddings = np.ascontiguousarray(new_embeddings, dtype=np.float32)
+            if self.quantize:
+                new_embeddings = quantize_i8(new_embeddings)
+
+            self._append(missing, new_embeddings)
+
+        return self.matrix[: len(self.tags)]
+
+    def unseen_tags(self, blob):
+        """Decode the tags of a NUL-separated UTF-8 blob that are not cached yet."""
+        return [
+            tag.decode("utf-8", "replace")
+            for tag in blob.split(b"\x00")
+            if tag and tag not in self.tag_to_idx_bytes
+        ]
+
+    def _append(self, tags, embeddings):
+        start = len(self.tags)
+        end = start + len(tags)
+
+        if end > self.matrix.shape[0]:
+            capacity = max(end, 2 * self.matrix.shape[0])
+            grown = np.empty((capacity, self.matrix.shape[1]), dtype=self.dtype)
+            grown[:start] = self.matrix[:start]
+            self.matrix = grown
+
+        self.matrix[start:end] = embeddings
+        for i, tag in enumerate(tags, start):
+            self.tag_to_idx[tag] = i
+            self.tag_to_idx_bytes[tag.encode()] = i
+        self.tags.extend(tags)
+        self.dirty = True
+
+    def _header(self):
+        return {
+            "model_name": self.cfg.get("model_name", "all-MiniLM-L6-v2"),
+            "backend": self.cfg.get("backend", "torch"),
+            "embedding_dim": self.matrix.shape[1],
+            "dtype": np.dtype(self.dtype).name,
+            "normalize_embeddings": self.cfg.get("normalize_embeddings", True),
+            "fp16": self.cfg.get("fp16", False),
+            "onnx_quantization": (
+                self.cfg.get("onnx_quantization", "avx2")
+                if self.cfg.get("backend") == "onnx"
+                else None
+            ),
+            "max_seq_length": self.cfg.get("max_seq_length", 128),
+        }
+
+    def load(self):
+        """Memory-map a previously saved cache if it matches the loaded model.
+
+        Stored rows are not scored until get_embeddings() asks for their tag.
+        """
+        try:
+            with open(self.path + ".json") as f:
+                meta = json.load(f)
+            matrix = np.load(self.path + ".npy", mmap_mode="r")
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"WARNING: Ignoring unreadable embedding cache: {e}", file=sys.stderr)
+            return
+
+        tags = meta.pop("tags", [])
+        if meta != self._header() or matrix.shape != (len(tags), self.matrix.shape[1]):
+            print("Embedding cache on disk is stale, ignoring it", file=sys.stderr)
+            return
+
+        self.stored_matrix = matrix
+        self.stored_idx = {tag: i for i, tag in enumerate(tags)}
+        print(f"Found {len(tags)} cached tag embeddings on disk", file=sys.stderr)
+
+    def save(self):
+        """Write the cache to disk if it changed since the last save."""
+        self._requests_since_save = 0
+        if not self.path or not self.dirty:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            meta = self._header()
+            meta["tags"] = self.tags
+
+            # Write-then-rename keeps the map held by a running process valid
+            tmp_suffix = f".{os.getpid()}.tmp"
+            with open(self.path + ".npy" + tmp_suffix, "wb") as f:
+                np.save(f, self.matrix[: len(self.tags)])
+            with open(self.path + ".json" + tmp_suffix, "w") as f:
+                json.dump(meta, f)
+            os.replace(self.path + ".npy" + tmp_suffix, self.path + ".npy")
+            os.replace(self.path + ".json" + tmp_suffix, self.path + ".json")
+            self.dirty = False
+        except OSError as e:
+            print(f"WARNING: Failed to save embedding cache: {e}", file=sys.stderr)
+
+    def checkpoint(self):
+        """Save the cache every save_interval requests, from the first change on."""
+        self._requests_since_save += 1
+        if self.dirty and self._requests_since_save >= self.save_interval:
+            self.save()
+
+    def score(self, doc_embedding):
+        """Return cached tags and their similarity to the document embedding.
+
+        The scores are a view of a buffer reused by the next call.
+        """
+        n = len(self.tags)
+        if self.scores.size < n:
+            self.scores = np.empty(self.matrix.shape[0], dtype=np.float32)
+
+        scores = self.scores[:n]
+        if n == 0:
+            return self.tags, scores
+
+        tag_matrix = self.matrix[:n]
+        if self.cfg.get("debug", False):
+            assert tag_matrix.dtype == self.dtype and tag_matrix.flags["C_CONTIGUOUS"]
+
+        doc_embedding = np.asarray(doc_embedding, dtype=np.float32)
+        if self.quantize:
+            compute_scores(tag_matrix, quantize_i8(doc_embedding), scores)
+            scores *= 1.0 / (I8_SCALE * I8_SCALE)
+            return self.tags, scores
+
+        return self.tags, compute_scores(tag_matrix, doc_embedding, scores)
+
+
+def mean_pooling_backbone(model, cfg):
+    """Return the underlying HF model when the pipeline is transformer + mean pooling.
+
+    Anything else (CLS pooling, dense layers, the ONNX backend) has to go through
+    encode() to produce the same embeddings as the tag cache.
+    """
+    if cfg.get("backend", "torch") != "torch":
+        return None
+    if not isinstance(model, torch.nn.Sequential):
+        return None
+
+    modules = list(model)
+    if (
+        len(modules) < 2
+        or not isinstance(modules[0], st_modules.Transformer)
+        or not isinstance(modules[1], st_modules.Pooling)
+        or not all(isinstance(m, st_modules.Normalize) for m in modules[2:])
+    ):
+        return None
+
+    pooling = modules[1]
+    mode = getattr(pooling, "pooling_mode", None) or pooling.get_pooling_mode_str()
+    if mode != "mean":
+        return None
+
+    return modules[0].auto_model
+
+
+class DocumentEncoder:
+    """Encodes document texts, remembering the most recently used embeddings."""
 
-            for i, nt in enumerate(new_tags):
-                self.cache[nt] = new_embeddings[i]
+    def __init__(self, model, cfg):
+        self.model = model
+        self.cfg = cfg
+        self.max_size = cfg.get("doc_cache_size", 1024)
+        # load_model() has already clamped max_seq_length to what the model accepts;
+        # 16 characters per token stays ahead of the tokenizer's own cut
+        seq_chars = 16 * cfg.get("max_seq_length", 128)
+        self.max_chars = cfg.get("max_text_chars") or seq_chars
+        self.cache = OrderedDict()
+        self.backbone = mean_pooling_backbone(model, cfg)
+        self.tokenize = getattr(model, "preprocess", None) or model.tokenize
+        self.normalize = cfg.get("normalize_embeddings", True) or (
+            self.backbone is not None and len(model) > 2
+        )
+
+    def _forward(self, texts):
+        """Tokenize, run the transformer and mean-pool, skipping encode()'s wrapper."""
+        # Tokenize the way encode() would (max_seq_length, tokenizer kwargs,
+        # lowercasing). sentence-transformers 6 renamed tokenize() to preprocess(),
+        # which can also return non-tensor entries
+        features = {
+            name: value.to(self.model.device)
+            for name, value in self.tokenize(texts).items()
+            if isinstance(value, torch.Tensor)
+        }
+
+        with torch.inference_mode():
+            hidden = self.backbone(**features).last_hidden_state
+            mask = features["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+            if self.normalize:
+                pooled = torch.nn.functional.normalize(pooled, p=2, dim=1)
+
+        return pooled.float().cpu().numpy()
+
+    def encode_many(self, texts):
+        """Embed texts in order, running the model once for all cache misses."""
+        # max_chars is well past max_seq_length tokens, which the tokenizer cuts
+        # anyway; this only spares it from walking multi-megabyte OCR output
+        texts = [t[: self.max_chars] for t in texts]
+        keys = [hashlib.blake2b(t.encode(), digest_size=16).digest() for t in texts]
+        embeddings = [None] * len(texts)
+        missing = {}
+        for i, key in enumerate(keys):
+            embedding = self.cache.get(key)
+            if embedding is not None:
+                self.cache.move_to_end(key)
+                embeddings[i] = embedding
+            else:
+                missing.setdefault(key, []).append(i)
+
+        if missing:
+            missing_texts = [texts[idx[0]] for idx in missing.values()]
+            if self.backbone is not None:
+                new_embeddings = self._forward(missing_texts)
+            else:
+                new_embeddings = self.model.encode(
+                    missing_texts,
+                    batch_size=self.cfg.get("max_batch_size", 32),
+                    normalize_embeddings=self.cfg.get("normalize_embeddings", True),
+                    convert_to_numpy=True,
+                    show_progress_bar=False,
+                ).astype(np.float32, copy=False)
+
+            for (key, idx), embedding in zip(missing.items(), new_embeddings):
+                for i in idx:
+                    embeddings[i] = embedding
+                if self.max_size > 0:
+                    self.cache[key] = embedding
+
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+        return embeddings
+
+
+class MessageReader:
+    """Reads length-prefixed messages straight from a file descriptor.
+
+    Owning the buffer (instead of going through sys.stdin) means select() on the
+    descriptor tells exactly whether more requests are pending.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.buffer = bytearray()
+        self.eof = False
+
+    def _fill(self):
+        chunk = os.read(self.fd, READ_CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+        self.buffer += chunk
+
+    def _pop(self):
+        if len(self.buffer) < FRAME_HEADER_SIZE:
+            return None
+
+        size = int.from_bytes(self.buffer[:FRAME_HEADER_SIZE], "little")
+        end = FRAME_HEADER_SIZE + size
+        if len(self.buffer) < end:
+            return None
+
+        message = bytes(self.buffer[FRAME_HEADER_SIZE:end])
+        del self.buffer[:end]
+        return message
+
+    def read(self):
+        """Block until the next message arrives. Returns None on EOF."""
+        while True:
+            message = self._pop()
+            if message is not None or self.eof:
+                return message
+            self._fill()
+
+    def read_batch(self, max_size, wait):
+        """Block for one message, then take up to max_size arriving within wait."""
+        first = self.read()
+        if first is None:
+            return []
+
+        batch = [first]
+        deadline = time.monotonic() + wait
+        while len(batch) < max_size:
+            message = self._pop()
+            if message is not None:
+                batch.append(message)
+                continue
+            if self.eof:
+                break
+
+            timeout = max(0.0, deadline - time.monotonic())
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+            if not ready:
+                break
+            self._fill()
+
+        return batch
+
+
+def safe_filename(name):
+    return re.sub(r"[^\w.-]", "_", name)
 
-        return self.cache
 
+def load_onnx_model(model_name, config):
+    """Load an int8-quantized ONNX export of the model, exporting it on first use."""
+    import onnxruntime as ort
+    from sentence_transformers import export_dynamic_quantized_onnx_model
 
-def load_model(model_name):
+    quantization = config.get("onnx_quantization", "avx2")
+    file_name = f"onnx/model_qint8_{quantization}.onnx"
+    base_dir = config.get("cache_dir") or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "models"
+    )
+    export_dir = os.path.join(base_dir, "onnx", safe_filename(model_name))
+
+    if not os.path.exists(os.path.join(export_dir, file_name)):
+        print(
+            f"Exporting {model_name} to quantized ONNX: {export_dir}", file=sys.stderr
+        )
+        onnx_model = SentenceTransformer(model_name, backend="onnx")
+        onnx_model.save(export_dir)
+        export_dynamic_quantized_onnx_model(onnx_model, quantization, export_dir)
+
+    session_options = ort.SessionOptions()
+    session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session_options.intra_op_num_threads = os.cpu_count() or 1
+
+    return SentenceTransformer(
+        export_dir,
+        backend="onnx",
+        model_kwargs={
+            "file_name": file_name,
+            "provider": "CPUExecutionProvider",
+            "session_options": session_options,
+        },
+    )
+
+
+def configure_torch_threads(config):
+    """Use every core for intra-op parallelism and a single inter-op thread."""
+    torch.set_num_threads(config.get("num_threads") or os.cpu_count() or 1)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set once, before any inter-op parallel work has started
+        pass
+
+
+def load_model(model_name, config):
     """Load the sentence transformer model."""
     print(f"Loading model: {model_name}", file=sys.stderr)
     try:
-        model = SentenceTransformer(model_name)
-        test_embed = model.encode(["test"], normalize_embeddings=True)
+        configure_torch_threads(config)
+
+        model = None
+        if config.get("backend") == "onnx":
+            try:
+                model = load_onnx_model(model_name, config)
+            except Exception as e:
+                print(
+                    f"WARNING: ONNX backend unavailable, falling back to torch: {e}",
+                    file=sys.stderr,
+                )
+                config["backend"] = "torch"
+
+        fp16 = False
+        if model is None:
+            model = SentenceTransformer(model_name)
+            fp16 = config.get("fp16", False) and model.device.type in ("cuda", "mps")
+            if fp16:
+                model.half()
+        # Record what was actually applied; the disk cache header compares it
+        config["fp16"] = fp16
+
+        # Attention cost grows with the square of the sequence length, and tag
+        # matching rarely needs more than the opening of a document. Never go past
+        # what the model supports, or position embeddings run out
+        limits = [
+            model.max_seq_length,
+            getattr(model.tokenizer, "model_max_length", None),
+        ]
+        limits = [n for n in limits if isinstance(n, int) and 0 < n < 100_000]
+        requested = int(config.get("max_seq_length") or 128)
+        max_seq_length = min([requested] + limits)
+        if max_seq_length < requested:
+            print(
+                f"WARNING: max_seq_length {requested} exceeds model limit, "
+                f"using {max_seq_length}",
+                file=sys.stderr,
+            )
+        model.max_seq_length = max_seq_length
+        config["max_seq_length"] = max_seq_length
+        test_embed = model.encode(
+            ["test"], normalize_embeddings=True, show_progress_bar=False
+        )
         embedding_dim = test_embed.shape[1]
         print(f"Model loaded. Embedding dimension: {embedding_dim}", file=sys.stderr)
         return model, embedding_dim
@@ -62,51 +556,108 @@ def load_model(model_name):
         return None, 0
 
 
-def process_single_request(request, model, embedding_cache, config):
-    """Process one request and return response."""
+def process_requests(requests, embedding_cache, doc_encoder, config):
+    """Process requests as one batch, retrying them one by one if the batch fails.
+
+    The retry keeps a single bad request from failing the others that happened
+    to arrive with it.
+    """
+    if not requests:
+        return []
+
+    try:
+        return process_batch(requests, embedding_cache, doc_encoder, config)
+    except Exception as e:
+        log_exception(e, config)
+        if len(requests) == 1:
+            return [
+                create_error_response(
+                    f"Unexpected error: {str(e)}", time.time(), config, e
+                )
+            ]
+
+    results = []
+    for request in requests:
+        try:
+            results.extend(
+                process_batch([request], embedding_cache, doc_encoder, config)
+            )
+        except Exception as e:
+            results.append(
+                create_error_response(
+                    f"Unexpected error: {str(e)}", time.time(), config, e
+                )
+            )
+            log_exception(e, config)
+    return results
+
+
+def process_batch(requests, embedding_cache, doc_encoder, config):
+    """Process requests in order, with one encode() for new tags and one for texts."""
     start_time = time.time()
 
-    text = request.get("text", "")
-    new_tags = request.get("new_tags", [])
+    texts = [r.get("text") for r in requests]
+    valid = [i for i, text in enumerate(texts) if text and isinstance(text, str)]
+
+    new_tags = []
+    for i in valid:
+        tags = requests[i].get("new_tags")
+        if isinstance(tags, list):
+            new_tags.extend(tags)
+        blob = requests[i].get("tags_blob")
+        if isinstance(blob, bytes):
+            new_tags.extend(embedding_cache.unseen_tags(blob))
+    embedding_cache.get_embeddings(new_tags)
+
+    doc_embeddings = dict(
+        zip(valid, doc_encoder.encode_many([texts[i] for i in valid]))
+    )
+
+    return [
+        process_single_request(
+            request, doc_embeddings.get(i), embedding_cache, config, start_time
+        )
+        for i, request in enumerate(requests)
+    ]
+
 
+def process_single_request(request, doc_embedding, embedding_cache, config, start_time):
+    """Score one request's precomputed document embedding against the cached tags."""
+    text = request.get("text")
     if not text or not isinstance(text, str):
         return create_error_response("Invalid or empty text", start_time, config)
 
-    if new_tags is None:
-        new_tags = []
-
-    if not isinstance(new_tags, list):
-        new_tags = []
-
     top_n = config.get("top_n", 15)
     min_similarity = float(config.get("min_similarity", 0.2))
-    normalize = config.get("normalize_embeddings", True)
 
-    all_embeddings = embedding_cache.get_embeddings(new_tags)
-    doc_embedding = model.encode([text], normalize_embeddings=normalize)[0]
+    tags, scores = embedding_cache.score(doc_embedding)
 
-    similarities = []
-    for tag, embeddings in all_embeddings.items():
-        similarity = float(np.dot(doc_embedding, embeddings))
-        similarities.append({"tag": tag, "score": similarity})
+    above = np.flatnonzero(scores >= min_similarity)
+    top = select_top(scores, above, top_n)
 
-    similarities.sort(key=lambda x: x["score"], reverse=True)
-    filtered = [s for s in similarities if s["score"] >= min_similarity]
-    suggested_tags = [s["tag"] for s in filtered[:top_n]]
-    top_similarities = filtered[:top_n]
+    top_similarities = [
+        {"tag": tags[i], "score": score} for i, score in zip(top, scores[top].tolist())
+    ]
+    suggested_tags = [s["tag"] for s in top_similarities]
 
     processing_time = (time.time() - start_time) * 1000
 
+    # The Go service only reads these three; the rest is for debugging by hand
     debug_info = {
-        "embedding_dimension": doc_embedding.shape[0],
         "processing_time_ms": round(processing_time),
-        "total_tags_considered": len(all_embeddings),
-        "tags_above_threshold": len(filtered),
-        "model_loaded": True,
-        "model_name": str(model),
-        "text_length_chars": len(text),
-        "text_estimated_tokens": len(text) // 4,
+        "total_tags_considered": len(tags),
+        "tags_above_threshold": int(above.size),
     }
+    if config.get("debug", False):
+        debug_info.update(
+            {
+                "embedding_dimension": doc_embedding.shape[0],
+                "model_loaded": True,
+                "model_name": config.get("model_repr", ""),
+                "text_length_chars": len(text),
+                "text_estimated_tokens": len(text) // 4,
+            }
+        )
 
     return {
         "suggested_tags": suggested_tags,
@@ -116,8 +667,12 @@ def process_single_request(request, model, embedding_cache, config):
     }
 
 
-def create_error_response(error_msg, start_time, config, traceback_str=None):
-    """Create an error response."""
+def create_error_response(error_msg, start_time, config, exc=None):
+    """Create an error response.
+
+    The traceback of exc is only formatted when the debug flag is set, so error
+    storms stay cheap.
+    """
     processing_time = (time.time() - start_time) * 1000
 
     debug_info = {
@@ -128,8 +683,10 @@ def create_error_response(error_msg, start_time, config, traceback_str=None):
         "embedding_dimension": 0,
     }
 
-    if traceback_str:
-        debug_info["traceback"] = traceback_str
+    if exc is not None and config.get("debug", False):
+        debug_info["traceback"] = "".join(
+            traceback.format_exception(type(exc), exc, exc.__traceback__)
+        )
 
     return {
         "suggested_tags": [],
@@ -139,70 +696,121 @@ def create_error_response(error_msg, start_time, config, traceback_str=None):
     }
 
 
+def parse_request(message):
+    """Decode a request frame: JSON, optionally followed by NUL and a tags blob.
+
+    JSON never contains a raw NUL byte, so the first one ends the JSON part.
+    """
+    end = message.find(b"\x00")
+    if end < 0:
+        return orjson.loads(message)
+
+    request = orjson.loads(memoryview(message)[:end])
+    if isinstance(request, dict):
+        request["tags_blob"] = message[end + 1 :]
+    return request
+
+
+def parse_message(message, config):
+    """Return (request, None) for a valid frame, or (None, error response)."""
+    try:
+        request = parse_request(message)
+    except orjson.JSONDecodeError as e:
+        return None, create_error_response(
+            f"Invalid JSON: {str(e)}", time.time(), config
+        )
+
+    if not isinstance(request, dict):
+        return None, create_error_response("Invalid request", time.time(), config)
+    return request, None
+
+
+def log_exception(exc, config):
+    """Log an exception to stderr, with its traceback only in debug mode."""
+    if config.get("debug", False):
+        lines = traceback.format_exception(type(exc), exc, exc.__traceback__)
+    else:
+        lines = traceback.format_exception_only(type(exc), exc)
+    print("ERROR in main loop: " + "".join(lines).rstrip(), file=sys.stderr)
+
+
+def write_message(message):
+    """Write one length-prefixed JSON message to stdout and flush it."""
+    payload = orjson.dumps(message, option=orjson.OPT_SERIALIZE_NUMPY)
+    sys.stdout.buffer.write(
+        len(payload).to_bytes(FRAME_HEADER_SIZE, "little") + payload
+    )
+    sys.stdout.buffer.flush()
+
+
 def main():
     """Main function - simple stdin/stdout loop."""
     print("Semantic Tag Matcher starting...", file=sys.stderr)
 
-    config_line = sys.stdin.readline()
-    if not config_line:
+    reader = MessageReader(sys.stdin.fileno())
+    config_message = reader.read()
+    if config_message is None:
         print("ERROR: No config received", file=sys.stderr)
         sys.exit(1)
 
     try:
-        config = json.loads(config_line.strip())
-    except json.JSONDecodeError as e:
+        config = orjson.loads(config_message)
+    except orjson.JSONDecodeError as e:
         print(f"ERROR: Invalid config JSON: {e}", file=sys.stderr)
         sys.exit(1)
 
     model_name = config.get("model_name", "all-MiniLM-L6-v2")
-    model, embedding_dim = load_model(model_name)
+    model, embedding_dim = load_model(model_name, config)
     if not model:
         sys.exit(1)
 
-    embedding_cache = EmbeddingCache(model, config)
+    if config.get("debug", False):
+        # str() walks the whole module tree, so only do it once
+        config["model_repr"] = str(model)
+
+    embedding_cache = EmbeddingCache(model, config, embedding_dim)
+    doc_encoder = DocumentEncoder(model, config)
 
     ready_msg = {"status": "ready", "embedding_dim": embedding_dim}
-    print(json.dumps(ready_msg), flush=True)
+    write_message(ready_msg)
 
     print(
-        "Semantic Tag Matcher initialized, waiting for cache warmp-up...", file=sys.stderr
+        "Semantic Tag Matcher initialized, waiting for cache warmp-up...",
+        file=sys.stderr,
     )
 
+    max_batch_size = config.get("max_batch_size", 32)
+    batch_wait = config.get("batch_wait_ms", 0) / 1000
+
     request_count = 0
     while True:
         try:
-            line = sys.stdin.readline()
-            if not line:  # EOF
+            messages = reader.read_batch(max_batch_size, batch_wait)
+            if not messages:  # EOF
                 print(f"EOF. Processed {request_count} requests.", file=sys.stderr)
+                embedding_cache.save()
                 break
 
-            line = line.strip()
-            if not line:
-                continue
-
-            try:
-                request = json.loads(line)
-            except json.JSONDecodeError as e:
-                error_resp = create_error_response(
-                    f"Invalid JSON: {str(e)}", time.time(), config
-                )
-                print(json.dumps(error_resp), flush=True)
-                continue
-
-            request_count += 1
-            response = process_single_request(request, model, embedding_cache, config)
-
-            print(json.dumps(response), flush=True)
+            parsed = [parse_message(message, config) for message in messages]
+            requests = [request for request, _ in parsed if request is not None]
+            request_count += len(requests)
+            results = iter(
+                process_requests(requests, embedding_cache, doc_encoder, config)
+            )
+            for request, error_resp in parsed:
+                write_message(error_resp if request is None else next(results))
+            embedding_cache.checkpoint()
 
         except KeyboardInterrupt:
             print("\nInterrupted. Shutting down.", file=sys.stderr)
+            embedding_cache.save()
             break
         except Exception as e:
             error_resp = create_error_response(
-                f"Unexpected error: {str(e)}", time.time(), config, traceback.format_exc()
+                f"Unexpected error: {str(e)}", time.time(), config, e
             )
-            print(json.dumps(error_resp), flush=True)
-            print(f"ERROR in main loop: {e}", file=sys.stderr)
+            write_message(error_resp)
+            log_exception(e, config)
 
 
 if __name__ == "__main__":